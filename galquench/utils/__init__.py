@@ -1,5 +1,6 @@
 from .illustris_parse_groupcats import (loadHalos, loadSubhalos)
 from .illustris_load import (
     read_supplementary, unpack_catalog_columns, match_subfind,
-    merge_subhalos_with_supplementary, apply_multiplicative_units,
-    apply_selection)
+    merge_subhalos_with_supplementary, catalog_to_structured,
+    expand_units, apply_multiplicative_units, apply_selection,
+    apply_units_and_selection)
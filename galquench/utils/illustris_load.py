@@ -1,8 +1,14 @@
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
 from warnings import warn
 import numpy
 import h5py
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
 
 def read_supplementary(file, subfindID, keys=None, skip_keys=None,
                        snapshot_number=None):
@@ -28,59 +34,84 @@ def read_supplementary(file, subfindID, keys=None, skip_keys=None,
     out : dict
         Dictionary with the requested data.
     """
-    data = h5py.File(file, "r")
-    # Get the snapshot
-    if snapshot_number is not None:
-        snapshot = "Snapshot_{}".format(snapshot_number)
-        if snapshot not in data.keys():
-            raise ValueError("Invalid snapshot number `{}`"
-                             .format(snapshot_number))
-        # Get just this snapshot
-        data = data[snapshot]
-    # Check that this is not a snapshot file
-    if any("Snapshot_" in key for key in data.keys()):
-        raise ValueError("This appears to be a file with snapshots. "
-                         "Specify `snapshot_number`.")
-    # Get keys
-    if keys is None:
-        keys = list(data.keys())
-    elif isinstance(keys, str):
-        keys = [keys]
-    elif isinstance(keys, list) and all(isinstance(key, str) for key in keys):
-        pass
-    else:
-        raise ValueError("`keys` must be either a string or a list "
-                         "of strings.")
-
-    # Check that we have a good subfind key
-    if subfindID not in data.keys():
-        suggestions = [key for key in data.keys() if "id" in key.lower()]
-        raise ValueError("subfindID of `{}` is invalid. Possibly one of `{}`."
-                         .format(subfindID, suggestions))
-    # Remove subfind ID from the list of keys
-    if subfindID in keys:
-        keys.remove(subfindID)
-
-    # Check that all keys are in the data file
-    for key in keys:
-        if key not in data.keys():
-            raise ValueError("Invalid key `{}`.".format(key))
-
-    # If any skip keys, remove them
-    if skip_keys is not None:
-        if isinstance(skip_keys, str):
-            skip_keys = [skip_keys]
-        for skip_key in skip_keys:
-            if skip_key in keys:
-                keys.remove(skip_key)
-
-    # Put into a dictionary and return
-    out = {"subfindID": numpy.asarray(data[subfindID]).astype(int)}
-    for key in keys:
-        d = data[key]
-        if isinstance(d, h5py._hl.dataset.Dataset):
-            d = numpy.asarray(d)
-        out.update({key: d})
+    # Widen the raw-data chunk cache well beyond the 1 MB h5py default so
+    # chunks shared between datasets are decompressed once, not once per
+    # key. The slot count is a prime well above the expected chunk count.
+    with h5py.File(file, "r", rdcc_nbytes=256 * 1024 * 1024,
+                   rdcc_nslots=100003, rdcc_w0=0.75) as archive:
+        data = archive
+        # Get the snapshot
+        if snapshot_number is not None:
+            snapshot = "Snapshot_{}".format(snapshot_number)
+            if snapshot not in data.keys():
+                raise ValueError("Invalid snapshot number `{}`"
+                                 .format(snapshot_number))
+            # Get just this snapshot
+            data = data[snapshot]
+        # Check that this is not a snapshot file
+        if any("Snapshot_" in key for key in data.keys()):
+            raise ValueError("This appears to be a file with snapshots. "
+                             "Specify `snapshot_number`.")
+        # Collect the keys to be skipped in a set for O(1) membership
+        # checks. The subfind ID is always read separately below.
+        if skip_keys is None:
+            skip = {subfindID}
+        elif isinstance(skip_keys, str):
+            skip = {skip_keys, subfindID}
+        else:
+            skip = set(skip_keys) | {subfindID}
+
+        # Enumerate the available datasets once
+        available = set(data.keys())
+
+        # Get keys, preserving their ordering
+        if keys is None:
+            keys = [key for key in data.keys() if key not in skip]
+        elif isinstance(keys, str):
+            keys = [keys] if keys not in skip else []
+        elif isinstance(keys, list) and all(isinstance(key, str)
+                                            for key in keys):
+            keys = [key for key in keys if key not in skip]
+        else:
+            raise ValueError("`keys` must be either a string or a list "
+                             "of strings.")
+
+        # Check that we have a good subfind key
+        if subfindID not in available:
+            suggestions = [key for key in available if "id" in key.lower()]
+            raise ValueError("subfindID of `{}` is invalid. Possibly one "
+                             "of `{}`.".format(subfindID, suggestions))
+
+        # Check that all keys are in the data file
+        for key in keys:
+            if key not in available:
+                raise ValueError("Invalid key `{}`.".format(key))
+            if not isinstance(data[key], h5py.Dataset):
+                raise ValueError("Key `{}` is not a dataset.".format(key))
+
+        # Put into a dictionary and return. The HDF5 library releases the
+        # GIL during I/O, so read the datasets concurrently to overlap the
+        # per-dataset read latency. `map` preserves the key ordering.
+        out = {"subfindID": _read_dataset(data[subfindID]).astype(int)}
+        if len(keys) > 0:
+            with ThreadPoolExecutor(
+                    max_workers=min(8, len(keys))) as pool:
+                for key, arr in zip(keys,
+                                    pool.map(lambda key: _read_dataset(
+                                        data[key]), keys)):
+                    out.update({key: arr})
+    return out
+
+
+def _read_dataset(dataset):
+    """
+    Read an HDF5 dataset into a freshly pre-allocated array via a single
+    `read_direct` call, avoiding the temporary buffer and extra copy that
+    `numpy.asarray(dataset)` would make.
+    """
+    out = numpy.empty(dataset.shape, dtype=dataset.dtype)
+    if out.size > 0:
+        dataset.read_direct(out)
     return out
 
 
@@ -100,14 +131,33 @@ def unpack_catalog_columns(catalog, column_mapping):
 
         columns = column_mapping[field]
         if not isinstance(columns, (list, tuple)):
-            cols = [cols]
+            columns = [columns]
 
-        data = catalog.pop(field)
+        data = numpy.ascontiguousarray(catalog.pop(field))
         for column in columns:
-            catalog.update({field + "_{}".format(column): data[:, column]})
+            # Copy so each extracted column is a contiguous 1D array rather
+            # than a strided view into the 2D data.
+            catalog.update(
+                {field + "_{}".format(column): data[:, column].copy()})
     return catalog
 
 
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _scatter_many(sid, data_stack, out_stack):
+        """
+        NaN-fill `out_stack` of shape `(k, N)` and scatter the rows of
+        `data_stack` of shape `(k, len(sid))` into it at positions `sid`,
+        parallelised over the k fields.
+        """
+        for j in prange(data_stack.shape[0]):
+            out_stack[j, :] = numpy.nan
+            for i in range(sid.size):
+                out_stack[j, sid[i]] = data_stack[j, i]
+else:
+    _scatter_many = None
+
+
 def match_subfind(catalogs, N):
     """
     Match data from supplementary catalogs by the subfind IDs by creating
@@ -134,15 +184,37 @@ def match_subfind(catalogs, N):
     if not all(isinstance(catalog, dict) for catalog in catalogs):
         raise TypeError("Entries of `catalogs` must be dictionaries.")
     for catalog in catalogs:
-        for key in catalog.keys():
-            # Ignore subfind ID
-            if key == "subfindID":
-                continue
+        sid = catalog["subfindID"]
+        keys = [key for key in catalog.keys() if key != "subfindID"]
+        int_keys = [key for key in keys
+                    if numpy.issubdtype(catalog[key].dtype, numpy.integer)]
+        float_keys = [key for key in keys if key not in int_keys]
+
+        # If numba is available scatter all floating point fields sharing a
+        # dtype in a single parallel pass over the fields.
+        if _scatter_many is not None and len(float_keys) > 0:
+            groups = {}
+            for key in float_keys:
+                groups.setdefault(catalog[key].dtype, []).append(key)
+            for dtype, group in groups.items():
+                data_stack = numpy.stack([catalog[key] for key in group])
+                out_stack = numpy.empty((len(group), N), dtype=dtype)
+                _scatter_many(sid, data_stack, out_stack)
+                for j, key in enumerate(group):
+                    catalog.update({key: out_stack[j]})
+            float_keys = []
+
+        for key in float_keys + int_keys:
             # Convert to an array matchign the sublos with the subfind IDs
-            # Put NaNs where no entry in this supplementary catalog
+            # Put NaNs where no entry in this supplementary catalog. Integer
+            # fields cannot hold a NaN, mark missing entries with -1 instead.
             data = catalog[key]
-            full = numpy.full(N, fill_value=numpy.nan, dtype=data.dtype)
-            full[catalog["subfindID"]] = data
+            if numpy.issubdtype(data.dtype, numpy.integer):
+                full = numpy.full(N, fill_value=-1, dtype=data.dtype)
+            else:
+                full = numpy.empty(N, dtype=data.dtype)
+                full.fill(numpy.nan)
+            full[sid] = data
             catalog.update({key: full})
     # Now that we matched by subfindID drop it
     for catalog in catalogs:
@@ -150,7 +222,8 @@ def match_subfind(catalogs, N):
     return catalogs
 
 
-def merge_subhalos_with_supplementary(subhalos, supplementary_catalogs):
+def merge_subhalos_with_supplementary(subhalos, supplementary_catalogs,
+                                      dtype_overrides=None):
     """
     Merge the `subhalos` dictionary with `supplementary_cats` dictionaries
     which have been rearranged by their subfind IDs via
@@ -162,11 +235,17 @@ def merge_subhalos_with_supplementary(subhalos, supplementary_catalogs):
         Subhalos dictionary from py:func:`loadSubhalos`.
     supplementary_catalogs : list of dictionaries
         Supplementary catalogs matched by their subfind IDs.
+    dtype_overrides : dict, optional
+        Dictionary mapping parameter name patterns (py:mod:`fnmatch` style,
+        e.g. `SFR_*`) to the data type the matching parameters are to be
+        cast to, e.g. `numpy.float32` for parameters whose physical
+        precision does not warrant 8 bytes. By default `None`, no casting.
 
     Returns
     -------
-    arr : structured array
-        Single structured array with the merged data.
+    catalog : dict
+        Dictionary with the merged data, one contiguous 1-dimensional array
+        per parameter.
     """
     if not isinstance(subhalos, dict):
         raise TypeError("`subhalos` must be a dictionary.")
@@ -176,78 +255,228 @@ def merge_subhalos_with_supplementary(subhalos, supplementary_catalogs):
     N = subhalos.pop("count", None)
     if N is None:
         raise ValueError("Subhaloes must contain key `count`.")
-    # Get the dtypes
-    dtype = {"names": [], "formats": []}
-    for catalog in [subhalos] + supplementary_catalogs:
-        for key, value in catalog.items():
-            dtype["names"].append(key)
-            dtype["formats"].append(value.dtype.type)
-    # Initialise the array and fill it
-    arr = numpy.full(N, numpy.nan, dtype=dtype)
+    # Merge into a single dictionary of contiguous arrays. Keeping each
+    # parameter as its own array (structure of arrays) means downstream
+    # per-parameter operations run over contiguous memory, unlike columns of
+    # a structured array which are strided by the record size.
+    merged = {}
     for catalog in [subhalos] + supplementary_catalogs:
         for key, value in catalog.items():
-            arr[key] = value
+            dtype = _match_dtype_override(key, dtype_overrides)
+            merged[key] = numpy.ascontiguousarray(value, dtype=dtype)
+    return merged
+
+
+def _match_dtype_override(name, dtype_overrides):
+    """
+    Return the data type whose pattern in `dtype_overrides` matches `name`,
+    or `None` if there is no match.
+    """
+    if dtype_overrides is None:
+        return None
+    for pattern, dtype in dtype_overrides.items():
+        if fnmatch(name, pattern):
+            return dtype
+    return None
+
+
+def catalog_to_structured(catalog, memmap_path=None):
+    """
+    Convert a catalog dictionary of 1-dimensional arrays into a single
+    structured array, e.g. for saving with py:func:`numpy.save`.
+
+    Arguments
+    ---------
+    catalog : dict
+        Dictionary with the catalog data.
+    memmap_path : str, optional
+        If given, back the structured array by a memory-mapped `.npy` file
+        at this path instead of allocating it in memory, so catalogs larger
+        than RAM can be assembled. By default `None`.
+
+    Returns
+    -------
+    arr : structured array
+        Single structured array with the catalog data. A memory-mapped
+        array if `memmap_path` is given.
+    """
+    if not isinstance(catalog, dict):
+        raise TypeError("`catalog` must be a dictionary.")
+    # Get the dtypes. Use the full `value.dtype` rather than its scalar
+    # type so byte order and item size carry over to the output.
+    fields = list(catalog.items())
+    dtype = numpy.dtype([(key, value.dtype) for key, value in fields])
+    # Initialise the array and fill it. Every field is overwritten below so
+    # there is no need to pre-fill the records.
+    N = len(next(iter(catalog.values())))
+    if memmap_path is None:
+        arr = numpy.empty(N, dtype=dtype)
+    else:
+        arr = numpy.lib.format.open_memmap(
+            memmap_path, mode="w+", dtype=dtype, shape=(N,))
+    for key, value in fields:
+        arr[key] = value
     return arr
 
 
-def apply_multiplicative_units(array, units):
+def expand_units(unit_patterns, names):
+    """
+    Expand case-insensitive substring unit patterns into an explicit
+    parameter-to-factor mapping over `names`.
+
+    Arguments
+    ---------
+    unit_patterns : dict
+        Dictionary where keys are substrings matched against parameter
+        names and values are the multiplicative factors.
+    names : list of str
+        Parameter names to be matched against.
+
+    Returns
+    -------
+    units : dict
+        Dictionary mapping matched parameter names to their factor.
     """
-    Apply multiplicative units, if such unit is specified in `array`.
+    lowered_patterns = [
+        (pattern.lower(), factor) for pattern, factor in
+        unit_patterns.items()]
+    units = {}
+    for name in names:
+        lowered_name = name.lower()
+        for pattern, factor in lowered_patterns:
+            if pattern in lowered_name:
+                units[name] = factor
+    return units
+
+
+def apply_multiplicative_units(catalog, units):
+    """
+    Apply multiplicative units to parameters of `catalog`.
 
     Arguments
     ---------
-    array : structured array
-        Structured array with data.
+    catalog : dict
+        Dictionary with the catalog data.
     units : dict
-        Dictionary where keys are the parameters (of `array`) are to be
-        multiplied by their value.
+        Dictionary mapping parameters (of `catalog`) to the factor they are
+        to be multiplied by. Substring patterns can be expanded into such a
+        mapping once per job via py:func:`expand_units`.
 
     """
-    for name in array.dtype.names:
-        for unit, factor in units.items():
-            if unit.lower() in name.lower():
-                msg = "Multiplying `{}` by {}.".format(name, factor)
-                warn(msg, RuntimeWarning)
-                array[name] *= factor
-    return array
+    for name, factor in units.items():
+        msg = "Multiplying `{}` by {}.".format(name, factor)
+        warn(msg, RuntimeWarning)
+        catalog[name] *= factor
+    return catalog
 
 
-def apply_selection(array, selection, only_finite=False):
+def apply_selection(catalog, selection, only_finite=False):
     """
-    Apply lower and upper limit selection to array.
+    Apply lower and upper limit selection to a catalog.
 
     Arguments
     ---------
-    array : structured array
-        Structured array with data to be selected.
+    catalog : dict
+        Dictionary with the catalog data to be selected.
     selection : dict
         Keys must be parameters and values the upper and lower limit.
     only_finite : bool, optional
         Whether to remove all samples that contain a NaN in any parameter.
         By default `False`.
 
-    out : structured array
-        Data array with selection applied.
+    out : dict
+        Catalog dictionary with selection applied.
     """
-    masks = [None] * len(selection)
+    N = len(next(iter(catalog.values())))
+    # Pre-allocate one boolean row per mask and fill the rows in place, so
+    # that the final AND is a single streaming reduction instead of a
+    # read-modify-write pass per mask.
+    nmasks = len(selection) + (len(catalog) if only_finite else 0)
+    masks = numpy.empty((nmasks, N), dtype=bool)
     for i, (par, lims) in enumerate(selection.items()):
         # Checks lims specified in a good format
         if not isinstance(lims, (tuple, list)) or len(lims) != 2:
             raise TypeError("`lims` of parameter `{}` must be a list or "
                             "tuple of length 2".format(par))
         lower, upper = lims
-        masks[i] = (lower < array[par]) & (array[par] < upper)
+        # No-op for catalogs already holding contiguous columns; otherwise
+        # pay one gather here so the comparisons run on contiguous memory.
+        col = numpy.ascontiguousarray(catalog[par])
+        numpy.logical_and(lower < col, col < upper, out=masks[i])
 
     if only_finite:
-        for param in array.dtype.names:
-            masks.append(numpy.isfinite(array[param]))
-
-    final_mask = masks[0]
-    if len(masks) > 1:
-        for mask in masks[1:]:
-            final_mask &= mask
-    Nrem = numpy.sum(~final_mask)
+        for j, param in enumerate(catalog.keys(), start=len(selection)):
+            numpy.isfinite(numpy.ascontiguousarray(catalog[param]),
+                           out=masks[j])
+
+    final_mask = numpy.logical_and.reduce(masks, axis=0)
+    return _select_rows(catalog, final_mask)
+
+
+def _select_rows(catalog, final_mask):
+    """
+    Select the rows of `catalog` flagged in `final_mask`, warning about the
+    removed fraction.
+    """
     N = final_mask.size
+    Nkeep = int(numpy.sum(final_mask))
+    Nrem = N - Nkeep
     warn("Removing {} ({:.2f}%) objects.".format(Nrem, Nrem / N * 100))
 
-    return array[final_mask]
+    # With few survivors gathering by index is cheaper than boolean
+    # indexing, which walks the full mask again for every parameter.
+    if Nkeep < 0.25 * N:
+        indices = numpy.flatnonzero(final_mask)
+        return {key: value.take(indices) for key, value in catalog.items()}
+    return {key: value[final_mask] for key, value in catalog.items()}
+
+
+def apply_units_and_selection(catalog, units, selection, only_finite=False):
+    """
+    Apply multiplicative units and the lower and upper limit selection in a
+    single pass over each parameter, so every column goes through all of its
+    operations while still in cache. Fuses py:func:`apply_multiplicative_units`
+    and py:func:`apply_selection`.
+
+    Arguments
+    ---------
+    catalog : dict
+        Dictionary with the catalog data.
+    units : dict
+        Dictionary mapping parameters (of `catalog`) to the factor they are
+        to be multiplied by, e.g. from py:func:`expand_units`.
+    selection : dict
+        Keys must be parameters and values the upper and lower limit.
+    only_finite : bool, optional
+        Whether to remove all samples that contain a NaN in any parameter.
+        By default `False`.
+
+    Returns
+    -------
+    out : dict
+        Catalog dictionary with units and selection applied.
+    """
+    for par, lims in selection.items():
+        if not isinstance(lims, (tuple, list)) or len(lims) != 2:
+            raise TypeError("`lims` of parameter `{}` must be a list or "
+                            "tuple of length 2".format(par))
+        if par not in catalog.keys():
+            raise ValueError("Invalid selection parameter `{}`.".format(par))
+
+    N = len(next(iter(catalog.values())))
+    final_mask = numpy.ones(N, dtype=bool)
+    buf = numpy.empty(N, dtype=bool)
+    for name, col in catalog.items():
+        factor = units.get(name)
+        if factor is not None:
+            msg = "Multiplying `{}` by {}.".format(name, factor)
+            warn(msg, RuntimeWarning)
+            col *= factor
+        if name in selection:
+            lower, upper = selection[name]
+            numpy.logical_and(lower < col, col < upper, out=buf)
+            numpy.logical_and(final_mask, buf, out=final_mask)
+        if only_finite:
+            numpy.isfinite(col, out=buf)
+            numpy.logical_and(final_mask, buf, out=final_mask)
+    return _select_rows(catalog, final_mask)
@@ -1,15 +1,17 @@
 import numpy
+import h5py
+import hdf5plugin
 
 from os.path import isfile
 import sys
 sys.path.append("../")
 from galquench.utils import (
     loadSubhalos, read_supplementary, unpack_catalog_columns, match_subfind,
-    merge_subhalos_with_supplementary, apply_multiplicative_units,
-    apply_selection)
+    merge_subhalos_with_supplementary, expand_units,
+    apply_units_and_selection)
 
 
-output_path = "/Users/richard/Projects/galquench/data/test.npy"
+output_path = "/Users/richard/Projects/galquench/data/test.h5"
 folder = "/Users/richard/Projects/galquench/data/tng100/"
 only_finite = False
 
@@ -53,6 +55,10 @@ multiplicative_units = {"SubhaloMass": 1e10}
 column_mapping = {"SubhaloMassType": (1, 4)}
 selection = {"SubhaloMassType_1": (0, 1e12),
              "SubhaloMassType_4": (0, 1e12)}
+# Masses and SFRs carry only a few significant digits, store as float32
+dtype_overrides = {"SubhaloMassType_*": numpy.float32,
+                   "SFR_*": numpy.float32,
+                   "m_neutral_H": numpy.float32}
 
 
 ###############################################################################
@@ -80,10 +86,12 @@ for catalog in [subhalos] + supplementary_cats:
     unpack_catalog_columns(catalog, column_mapping)
 
 match_subfind(supplementary_cats, subhalos["count"])
-arr = merge_subhalos_with_supplementary(subhalos, supplementary_cats)
-apply_multiplicative_units(arr, multiplicative_units)
+catalog = merge_subhalos_with_supplementary(subhalos, supplementary_cats,
+                                            dtype_overrides=dtype_overrides)
+units = expand_units(multiplicative_units, catalog.keys())
 
-out = apply_selection(arr, selection, only_finite=only_finite)
+out = apply_units_and_selection(catalog, units, selection,
+                                only_finite=only_finite)
 
 ans = 'Y'
 if isfile(output_path):
@@ -95,7 +103,14 @@ if isfile(output_path):
         print("Invalid input `{}`. Must be one of `{}`".format(ans, inps))
 
 if ans == 'Y':
-    numpy.save(output_path, out)
+    # One chunked, bitshuffle-compressed dataset per parameter. Compared to
+    # an uncompressed `.npy` this shrinks the file several-fold and allows
+    # reading single parameters without touching the rest.
+    with h5py.File(output_path, "w") as f:
+        for name, col in out.items():
+            f.create_dataset(name, data=numpy.ascontiguousarray(col),
+                             chunks=(min(len(col), 65536),),
+                             **hdf5plugin.Bitshuffle(cname="lz4"))
     print("Job completed. Output saved to `{}`.".format(output_path))
 else:
     print("Job completed but not saved.")